@@ -0,0 +1,225 @@
+"""
+FILE: llm_cache.py
+Response caches for deterministic (temperature 0) LLM calls
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Numbers and URLs a semantic hit must reproduce exactly: near-identical
+# prompts that differ only in a figure or an endpoint need different answers
+_SIGNATURE_RE = re.compile(r'https?://\S+|\d+(?:[.,]\d+)*')
+
+
+def make_key(model, messages, temperature=0, tools=None):
+    """Build a stable cache key from the request parameters"""
+    raw = json.dumps(
+        {'m': model, 'p': messages, 't': temperature, 'tools': tools},
+        sort_keys=True
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class LLMCache:
+    """In-memory LRU cache with TTL, optionally backed by Redis (REDIS_URL)"""
+
+    def __init__(self, max_entries=1024, prefix='llm:'):
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self._entries = OrderedDict()
+        self._redis = None
+        self._redis_checked = False
+
+    def _get_redis(self):
+        """Connect to Redis on first use if REDIS_URL is set"""
+        if not self._redis_checked:
+            self._redis_checked = True
+            redis_url = os.getenv('REDIS_URL')
+            if redis_url:
+                try:
+                    import redis.asyncio as redis
+                    self._redis = redis.from_url(redis_url)
+                    logger.info("✅ LLM cache using Redis backend")
+                except Exception as e:
+                    logger.warning(f"❌ Redis cache unavailable, using memory: {str(e)}")
+                    self._redis = None
+        return self._redis
+
+    async def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        client = self._get_redis()
+        if client is not None:
+            try:
+                raw = await client.get(self.prefix + key)
+                if raw is not None:
+                    return json.loads(raw)
+            except Exception as e:
+                logger.warning(f"Redis cache get failed: {str(e)}")
+        return None
+
+    async def set(self, key, value, ttl=3600):
+        """Store value under key for ttl seconds"""
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        client = self._get_redis()
+        if client is not None:
+            try:
+                await client.set(self.prefix + key, json.dumps(value), ex=ttl)
+            except Exception as e:
+                logger.warning(f"Redis cache set failed: {str(e)}")
+
+
+class SemanticCache:
+    """Embedding-similarity cache for near-duplicate prompts, persisted as .npz + JSON"""
+
+    def __init__(self, threshold=0.92, max_entries=256):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._embed_mat = None
+        self._answers = []
+        self._models = []
+        self._signatures = []
+        self._last_used = []
+        self._clock = 0
+        self._path = None
+        self._loaded = False
+        self._dirty = False
+
+    def _ensure_loaded(self):
+        """Load persisted entries from SEMANTIC_CACHE_PATH(.npz/.json) on first use"""
+        if self._loaded:
+            return
+        self._loaded = True
+        self._path = os.getenv('SEMANTIC_CACHE_PATH', 'semantic_cache')
+        if not (os.path.exists(self._path + '.npz') and os.path.exists(self._path + '.json')):
+            return
+        try:
+            with np.load(self._path + '.npz', allow_pickle=False) as arrays:
+                embed_mat = arrays['embed_mat']
+            with open(self._path + '.json', encoding='utf-8') as fh:
+                state = json.load(fh)
+            if len(state['answers']) != embed_mat.shape[0]:
+                raise ValueError("embedding and answer counts differ")
+            self._embed_mat = embed_mat
+            self._answers = state['answers']
+            self._models = state['models']
+            self._signatures = state['signatures']
+            self._last_used = list(range(len(self._answers)))
+            self._clock = len(self._answers)
+            logger.info(f"Semantic cache loaded: {len(self._answers)} entries")
+        except Exception as e:
+            logger.warning(f"Failed to load semantic cache: {str(e)}")
+
+    @staticmethod
+    def _write(path, embed_mat, state):
+        """Write a snapshot to path.npz/path.json, replacing the old files atomically"""
+        with open(path + '.npz.tmp', 'wb') as fh:
+            np.savez(fh, embed_mat=embed_mat)
+        with open(path + '.json.tmp', 'w', encoding='utf-8') as fh:
+            json.dump(state, fh)
+        os.replace(path + '.npz.tmp', path + '.npz')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    async def persist(self):
+        """Save entries added since the last save, off the event loop"""
+        if not self._dirty or self._embed_mat is None:
+            return
+        self._dirty = False
+        state = {
+            'answers': list(self._answers),
+            'models': list(self._models),
+            'signatures': list(self._signatures)
+        }
+        try:
+            await asyncio.to_thread(self._write, self._path, self._embed_mat.copy(), state)
+        except Exception as e:
+            self._dirty = True
+            logger.warning(f"Failed to persist semantic cache: {str(e)}")
+
+    @staticmethod
+    def normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    @staticmethod
+    def signature(prompt):
+        """Number and URL tokens of a prompt, in order"""
+        return _SIGNATURE_RE.findall(prompt)
+
+    def lookup(self, q_vec, model, prompt):
+        """Return the answer of the most similar cached prompt above threshold
+
+        Only entries from the same model whose numbers and URLs match the
+        prompt exactly are considered.
+        """
+        self._ensure_loaded()
+        if self._embed_mat is None or len(self._answers) == 0:
+            return None
+        if self._embed_mat.shape[1] != q_vec.shape[0]:
+            return None
+
+        signature = self.signature(prompt)
+        scores = self._embed_mat @ q_vec
+        for idx in np.argsort(-scores):
+            idx = int(idx)
+            if scores[idx] <= self.threshold:
+                break
+            if self._models[idx] != model or self._signatures[idx] != signature:
+                continue
+            self._clock += 1
+            self._last_used[idx] = self._clock
+            logger.info(f"Semantic cache hit (similarity {scores[idx]:.3f})")
+            return self._answers[idx]
+        return None
+
+    def add(self, q_vec, model, prompt, answer):
+        """Store a normalized prompt embedding with its answer, evicting LRU when full"""
+        self._ensure_loaded()
+        self._clock += 1
+        signature = self.signature(prompt)
+        if self._embed_mat is None or self._embed_mat.shape[1] != q_vec.shape[0]:
+            self._embed_mat = q_vec[np.newaxis, :].copy()
+            self._answers = [answer]
+            self._models = [model]
+            self._signatures = [signature]
+            self._last_used = [self._clock]
+        elif len(self._answers) < self.max_entries:
+            self._embed_mat = np.vstack([self._embed_mat, q_vec])
+            self._answers.append(answer)
+            self._models.append(model)
+            self._signatures.append(signature)
+            self._last_used.append(self._clock)
+        else:
+            victim = int(np.argmin(self._last_used))
+            self._embed_mat[victim] = q_vec
+            self._answers[victim] = answer
+            self._models[victim] = model
+            self._signatures[victim] = signature
+            self._last_used[victim] = self._clock
+        self._dirty = True
+
+
+llm_cache = LLMCache()
+semantic_cache = SemanticCache()
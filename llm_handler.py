@@ -5,18 +5,130 @@ Integration with LLM APIs (OpenAI, Anthropic)
 
 import os
 import json
+import time
+import random
+import asyncio
 import logging
 import sys
+from itertools import islice
+import orjson
+from llm_cache import llm_cache, semantic_cache, make_key
 
 logger = logging.getLogger(__name__)
 
+# Invariant instructions go first as system prompts so providers can reuse the
+# cached prefix; only the question-specific text changes between calls
+PLAN_SYSTEM_PROMPT = """You are a data analysis expert. Given a quiz question, create a step-by-step plan.
+
+Respond with ONLY valid JSON (no markdown, no extra text):
+{
+  "steps": ["step 1", "step 2", ...],
+  "data_sources": "where to get data",
+  "processing": "how to process",
+  "expected_answer_type": "number/string/boolean/json"
+}"""
+
+SOLVE_SYSTEM_PROMPT = "Answer the quiz question with ONLY the answer, no explanation or extra text."
+
+ANALYZE_SYSTEM_PROMPT = "Analyze the data and complete the task. Provide only the answer."
+
+ANTHROPIC_CACHE_HEADERS = {'anthropic-beta': 'prompt-caching-2024-07-31'}
+
+
+def _openai_messages(system, prompt):
+    return [
+        {'role': 'system', 'content': system},
+        {'role': 'user', 'content': prompt}
+    ]
+
+
+def _anthropic_system(system):
+    """System block marked for Anthropic prompt caching"""
+    return [{'type': 'text', 'text': system, 'cache_control': {'type': 'ephemeral'}}]
+
+
+def to_prompt_json(data, limit, sample=50):
+    """Serialize data for a prompt, sampling large containers before truncating to limit"""
+    if isinstance(data, list) and len(data) > sample:
+        data = data[:sample]
+    elif isinstance(data, dict) and len(data) > sample:
+        data = dict(islice(data.items(), sample))
+    raw = orjson.dumps(
+        data,
+        default=str,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    )
+    return raw[:limit].decode('utf-8', errors='ignore')
+
+# Process-wide clients, so the TLS connection pool is reused across quizzes
+_openai_client = None
+_anthropic_client = None
+
+
+class Throttle:
+    """Token bucket limiting requests and tokens per minute across all calls"""
+    
+    def __init__(self, rpm=3500, tpm=90000):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+    
+    async def acquire(self, est_tokens):
+        """Wait until there is capacity for one request of est_tokens"""
+        est_tokens = min(est_tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= est_tokens:
+                    self._requests -= 1
+                    self._tokens -= est_tokens
+                    return
+                wait = max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (est_tokens - self._tokens) * 60 / self.tpm
+                )
+                await asyncio.sleep(wait)
+
+
+MAX_ATTEMPTS = 5
+_THROTTLE = Throttle(rpm=3500, tpm=90000)
+_LLM_SEMAPHORE = asyncio.Semaphore(20)
+
+
+def _is_retryable(error):
+    """Retry rate limits, server errors and connection failures"""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def _pooled_http_client():
+    """Shared-pool async HTTP client for the LLM SDKs"""
+    import httpx
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        timeout=httpx.Timeout(60.0, connect=10.0)
+    )
+
 
 class LLMHandler:
     def __init__(self):
         self.openai_key = os.getenv('OPENAI_API_KEY')
         self.anthropic_key = os.getenv('ANTHROPIC_API_KEY')
         self.model = os.getenv('LLM_MODEL', 'gpt-4-turbo')
-        self.client = None
+        self.anthropic_model = "claude-3-5-sonnet-20241022"
+        self.aclient = None
         self.provider = None
         
         # Try OpenAI first
@@ -24,28 +136,31 @@ class LLMHandler:
             try:
                 # Uninstall old version and use requests directly
                 import requests
-                self.client = self._create_openai_client()
+                self.aclient = self._create_openai_client()
                 self.provider = 'openai'
                 logger.info("✅ OpenAI client initialized successfully")
             except Exception as e:
                 logger.warning(f"❌ OpenAI initialization failed: {str(e)}")
-                self.client = None
+                self.aclient = None
         
         # Fallback to Anthropic
-        if not self.client and self.anthropic_key:
+        if not self.aclient and self.anthropic_key:
             try:
-                self.client = self._create_anthropic_client()
+                self.aclient = self._create_anthropic_client()
                 self.provider = 'anthropic'
                 logger.info("✅ Anthropic client initialized successfully")
             except Exception as e:
                 logger.warning(f"❌ Anthropic initialization failed: {str(e)}")
-                self.client = None
+                self.aclient = None
         
-        if not self.client:
+        if not self.aclient:
             logger.error("❌ No LLM client could be initialized - check API keys in .env")
     
     def _create_openai_client(self):
-        """Create OpenAI client with minimal parameters"""
+        """Return the process-wide async OpenAI client, creating it once"""
+        global _openai_client
+        if _openai_client is not None:
+            return _openai_client
         try:
             # Try importing the library first
             import importlib.util
@@ -53,60 +168,149 @@ class LLMHandler:
             if spec is None:
                 raise ImportError("openai not installed")
             
-            from openai import OpenAI
-            # Create client with ONLY required parameters
-            client = OpenAI(api_key=self.openai_key)
-            return client
+            from openai import AsyncOpenAI
+            _openai_client = AsyncOpenAI(
+                api_key=self.openai_key,
+                max_retries=0,
+                http_client=_pooled_http_client()
+            )
+            return _openai_client
         except Exception as e:
             logger.error(f"Failed to create OpenAI client: {str(e)}")
             raise
     
     def _create_anthropic_client(self):
-        """Create Anthropic client with minimal parameters"""
+        """Return the process-wide async Anthropic client, creating it once"""
+        global _anthropic_client
+        if _anthropic_client is not None:
+            return _anthropic_client
         try:
-            from anthropic import Anthropic
-            client = Anthropic(api_key=self.anthropic_key)
-            return client
+            from anthropic import AsyncAnthropic
+            _anthropic_client = AsyncAnthropic(
+                api_key=self.anthropic_key,
+                max_retries=0,
+                http_client=_pooled_http_client()
+            )
+            return _anthropic_client
         except Exception as e:
             logger.error(f"Failed to create Anthropic client: {str(e)}")
             raise
     
-    def plan_solution(self, question):
+    def _model_tag(self):
+        """Provider and model answering calls, e.g. 'openai:gpt-4o-mini'"""
+        model = self.model if self.provider == 'openai' else self.anthropic_model
+        return f"{self.provider}:{model}"
+    
+    def _cache_key(self, system, prompt):
+        """Cache key for a deterministic (temperature 0) call with the active model"""
+        return make_key(self._model_tag(), [system, prompt], temperature=0)
+    
+    async def _acall(self, create, prompt, **kwargs):
+        """Call an SDK method under the concurrency cap and rate limit, with backoff"""
+        est_tokens = len(prompt) // 4 + kwargs.get('max_tokens', 500)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                async with _LLM_SEMAPHORE:
+                    await _THROTTLE.acquire(est_tokens)
+                    return await create(**kwargs)
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS or not _is_retryable(e):
+                    raise
+                delay = min(2 ** attempt, 30) * (0.5 + random.random())
+                logger.warning(f"LLM call failed ({str(e)}), retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _early_answer(text):
+        """First line of a streamed answer once that line is complete, else None"""
+        head = text.lstrip()
+        # JSON and fenced answers span several lines, so never cut those short
+        if not head or head[0] in '{[`' or '\n' not in head:
+            return None
+        return head.split('\n', 1)[0].strip()
+    
+    async def _astream_openai(self, **kwargs):
+        """Stream an OpenAI chat completion, stopping at the first complete answer line"""
+        stream = await self.aclient.chat.completions.create(stream=True, **kwargs)
+        text = ""
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    early = self._early_answer(text)
+                    if early:
+                        return early
+        finally:
+            await stream.close()
+        return text.strip()
+    
+    async def _astream_anthropic(self, **kwargs):
+        """Stream an Anthropic message, stopping at the first complete answer line"""
+        text = ""
+        async with self.aclient.messages.stream(**kwargs) as stream:
+            async for piece in stream.text_stream:
+                text += piece
+                early = self._early_answer(text)
+                if early:
+                    return early
+        return text.strip()
+    
+    @staticmethod
+    def _parse_answer(answer):
+        """Try to parse an answer as a number, else return it unchanged"""
+        try:
+            if '.' in str(answer):
+                return float(answer)
+            else:
+                return int(answer)
+        except (ValueError, AttributeError):
+            return answer
+    
+    async def _aembed(self, text):
+        """Embed text for the semantic cache (OpenAI only); None when unavailable"""
+        if self.provider != 'openai':
+            return None
+        try:
+            response = await self._acall(
+                self.aclient.embeddings.create, text,
+                model="text-embedding-3-small",
+                input=text
+            )
+            return semantic_cache.normalize(response.data[0].embedding)
+        except Exception as e:
+            logger.warning(f"Embedding failed, skipping semantic cache: {str(e)}")
+            return None
+    
+    async def aplan_solution(self, question):
         """Ask LLM to plan the solution approach"""
-        if not self.client:
+        if not self.aclient:
             logger.error("No LLM client available")
             return {'steps': ['Unable to plan - no LLM']}
         
-        prompt = f"""You are a data analysis expert. Given this quiz question, create a step-by-step plan.
-
-Question: {question}
-
-Respond with ONLY valid JSON (no markdown, no extra text):
-{{
-  "steps": ["step 1", "step 2", ...],
-  "data_sources": "where to get data",
-  "processing": "how to process",
-  "expected_answer_type": "number/string/boolean/json"
-}}"""
+        prompt = f"Question: {question}"
         
         try:
             if self.provider == 'openai':
-                response = self.client.chat.completions.create(
+                response = await self._acall(
+                    self.aclient.chat.completions.create, prompt,
                     model=self.model,
-                    messages=[{'role': 'user', 'content': prompt}],
+                    messages=_openai_messages(PLAN_SYSTEM_PROMPT, prompt),
                     temperature=0.5
                 )
                 response_text = response.choices[0].message.content
-                return json.loads(response_text)
+                return orjson.loads(response_text)
             
             elif self.provider == 'anthropic':
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
+                response = await self._acall(
+                    self.aclient.messages.create, prompt,
+                    model=self.anthropic_model,
                     max_tokens=1000,
-                    messages=[{'role': 'user', 'content': prompt}]
+                    system=_anthropic_system(PLAN_SYSTEM_PROMPT),
+                    messages=[{'role': 'user', 'content': prompt}],
+                    extra_headers=ANTHROPIC_CACHE_HEADERS
                 )
                 response_text = response.content[0].text
-                return json.loads(response_text)
+                return orjson.loads(response_text)
             else:
                 return {'steps': ['No provider']}
         
@@ -117,82 +321,105 @@ Respond with ONLY valid JSON (no markdown, no extra text):
             logger.error(f"Error in plan_solution: {str(e)}")
             return {'steps': ['Error in planning']}
     
-    def solve_generic(self, question):
+    async def asolve_generic(self, question, semantic=True):
         """Use LLM for generic problem solving"""
-        if not self.client:
+        if not self.aclient:
             logger.error("No LLM client available")
             return "Error: No LLM available"
         
-        prompt = f"""Answer this quiz question with ONLY the answer, no explanation or extra text.
-
-Question: {question}
+        prompt = f"""Question: {question}
 
 Answer:"""
         
+        key = self._cache_key(SOLVE_SYSTEM_PROMPT, prompt)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            logger.info("LLM cache hit in solve_generic")
+            return cached
+        
+        # Callers pass semantic=False when the question embeds fetched data,
+        # since prompts differing only in their data must not share an answer
+        q_vec = await self._aembed(prompt) if semantic else None
+        if q_vec is not None:
+            cached = semantic_cache.lookup(q_vec, self._model_tag(), prompt)
+            if cached is not None:
+                return cached
+        
         try:
             if self.provider == 'openai':
-                response = self.client.chat.completions.create(
+                answer = await self._acall(
+                    self._astream_openai, prompt,
                     model=self.model,
-                    messages=[{'role': 'user', 'content': prompt}],
+                    messages=_openai_messages(SOLVE_SYSTEM_PROMPT, prompt),
                     temperature=0
                 )
-                answer = response.choices[0].message.content.strip()
             
             elif self.provider == 'anthropic':
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
+                answer = await self._acall(
+                    self._astream_anthropic, prompt,
+                    model=self.anthropic_model,
                     max_tokens=500,
-                    messages=[{'role': 'user', 'content': prompt}]
+                    system=_anthropic_system(SOLVE_SYSTEM_PROMPT),
+                    messages=[{'role': 'user', 'content': prompt}],
+                    temperature=0,
+                    extra_headers=ANTHROPIC_CACHE_HEADERS
                 )
-                answer = response.content[0].text.strip()
             else:
                 answer = "No provider"
             
-            # Try to parse as number
-            try:
-                if '.' in str(answer):
-                    return float(answer)
-                else:
-                    return int(answer)
-            except (ValueError, AttributeError):
-                return answer
+            answer = self._parse_answer(answer)
+            await llm_cache.set(key, answer, ttl=3600)
+            if q_vec is not None:
+                semantic_cache.add(q_vec, self._model_tag(), prompt, answer)
+            return answer
         
         except Exception as e:
             logger.error(f"Error in solve_generic: {str(e)}")
             return f"Error: {str(e)}"
     
-    def analyze_data(self, data, instruction):
+    async def aanalyze_data(self, data, instruction):
         """Ask LLM to analyze data"""
-        if not self.client:
+        if not self.aclient:
             logger.error("No LLM client available")
             return "Error: No LLM available"
         
-        prompt = f"""Analyze this data and complete the task.
+        prompt = f"""Data: {to_prompt_json(data, 1000)}
 
-Data: {json.dumps(data)[:1000]}
-
-Task: {instruction}
-
-Provide only the answer."""
+Task: {instruction}"""
+        
+        key = self._cache_key(ANALYZE_SYSTEM_PROMPT, prompt)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            logger.info("LLM cache hit in analyze_data")
+            return cached
         
         try:
             if self.provider == 'openai':
-                response = self.client.chat.completions.create(
+                response = await self._acall(
+                    self.aclient.chat.completions.create, prompt,
                     model=self.model,
-                    messages=[{'role': 'user', 'content': prompt}]
+                    messages=_openai_messages(ANALYZE_SYSTEM_PROMPT, prompt),
+                    temperature=0
                 )
-                return response.choices[0].message.content.strip()
+                answer = response.choices[0].message.content.strip()
             
             elif self.provider == 'anthropic':
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
+                response = await self._acall(
+                    self.aclient.messages.create, prompt,
+                    model=self.anthropic_model,
                     max_tokens=1000,
-                    messages=[{'role': 'user', 'content': prompt}]
+                    system=_anthropic_system(ANALYZE_SYSTEM_PROMPT),
+                    messages=[{'role': 'user', 'content': prompt}],
+                    temperature=0,
+                    extra_headers=ANTHROPIC_CACHE_HEADERS
                 )
-                return response.content[0].text.strip()
+                answer = response.content[0].text.strip()
             
             else:
                 return "No provider"
+            
+            await llm_cache.set(key, answer, ttl=3600)
+            return answer
         
         except Exception as e:
             logger.error(f"Error in analyze_data: {str(e)}")
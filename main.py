@@ -1,19 +1,22 @@
 """
 FILE: main.py
-Main Flask API server for the LLM Quiz Solver
+Main Quart (async Flask) API server for the LLM Quiz Solver
 """
 
-from flask import Flask, request, jsonify
+from quart import Quart, request, jsonify
 import os
 from dotenv import load_dotenv
-from quiz_solver import QuizSolver
+from quiz_solver import QuizSolver, browser_pool, close_http_session, shutdown_executors
+from llm_cache import semantic_cache
 import logging
 from functools import wraps
+import hmac
+from cachetools import TTLCache
 import time
 
 load_dotenv()
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # Configure logging
 logging.basicConfig(
@@ -23,32 +26,40 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 SECRET = os.getenv('SECRET_STRING')
+SECRET_BYTES = SECRET.encode() if SECRET else None
 EMAIL = os.getenv('EMAIL')
 
-active_sessions = {}
+# One solver for the process; it holds no per-request state, only shared clients
+SOLVER = QuizSolver()
+
+# Sessions expire 3 minutes after they start; bounded so unique emails can't grow it forever
+active_sessions = TTLCache(maxsize=10_000, ttl=180)
 
 
 def verify_secret(f):
     @wraps(f)
-    def decorated_function(*args, **kwargs):
-        data = request.get_json()
+    async def decorated_function(*args, **kwargs):
+        data = await request.get_json()
         
         if not data:
             return jsonify({'error': 'Invalid JSON'}), 400
         
-        if data.get('secret') != SECRET:
+        # surrogatepass: JSON can carry lone surrogates ('\ud800') that strict UTF-8 rejects
+        provided = data.get('secret')
+        if (SECRET_BYTES is None or not isinstance(provided, str)
+                or not hmac.compare_digest(provided.encode('utf-8', 'surrogatepass'), SECRET_BYTES)):
             logger.warning(f"Invalid secret attempted from {request.remote_addr}")
             return jsonify({'error': 'Invalid secret'}), 403
         
-        return f(*args, **kwargs)
+        return await f(*args, **kwargs)
     return decorated_function
 
 
 @app.route('/quiz', methods=['POST'])
 @verify_secret
-def quiz():
+async def quiz():
     try:
-        data = request.get_json()
+        data = await request.get_json()
         email = data.get('email')
         quiz_url = data.get('url')
         
@@ -58,39 +69,30 @@ def quiz():
         # Use email as session key (not email+url, to allow multiple quizzes)
         session_key = email
         
-        if session_key not in active_sessions:
-            active_sessions[session_key] = {
+        session = active_sessions.get(session_key)
+        if session is None:
+            session = {
                 'start_time': time.time(),
                 'attempts': 0
             }
+            active_sessions[session_key] = session
             logger.info(f"New session: {email}")
         
-        elapsed = time.time() - active_sessions[session_key]['start_time']
-        if elapsed > 180:
-            logger.warning(f"Session timeout for {email}")
-            # Reset session if timeout
-            active_sessions[session_key] = {
-                'start_time': time.time(),
-                'attempts': 0
-            }
-            return jsonify({'error': 'Quiz timeout (3 minutes exceeded)'}), 408
-        
-        logger.info(f"Processing quiz for {email} - Attempt {active_sessions[session_key]['attempts'] + 1}")
+        logger.info(f"Processing quiz for {email} - Attempt {session['attempts'] + 1}")
         
         try:
-            solver = QuizSolver()
-            answer = solver.solve(quiz_url)
+            answer = await SOLVER.solve(quiz_url, email)
             
             logger.info(f"Answer generated: {answer}")
             
-            result = solver.submit_answer(
+            result = await SOLVER.submit_answer(
                 email=email,
                 secret=SECRET,
                 url=quiz_url,
                 answer=answer
             )
             
-            active_sessions[session_key]['attempts'] += 1
+            session['attempts'] += 1
             
             logger.info(f"Result: {result}")
             return jsonify(result), 200
@@ -103,11 +105,20 @@ def quiz():
         return jsonify({'error': str(e)}), 500
 
 
+@app.after_serving
+async def shutdown():
+    await close_http_session()
+    await browser_pool.close()
+    shutdown_executors()
+    await semantic_cache.persist()
+
+
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     return jsonify({'status': 'ok'}), 200
 
 
 if __name__ == '__main__':
     logger.info("Starting Quiz Solver Server on http://0.0.0.0:5000")
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    # Quart's run() reloads on file changes by default; never in production
+    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
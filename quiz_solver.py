@@ -4,28 +4,99 @@ Core logic for solving quizzes
 """
 
 import asyncio
-import requests
-import json
+import aiohttp
 import logging
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from llm_handler import LLMHandler
+from llm_cache import llm_cache, make_key
+from llm_handler import LLMHandler, to_prompt_json
 
 logger = logging.getLogger(__name__)
 
+# Question keywords per strategy, in priority order
+QUESTION_CATEGORIES = [
+    ('file', ['download', 'file']),
+    ('api', ['api', 'endpoint']),
+    ('analysis', ['sum', 'average', 'count', 'analyze']),
+    ('visualization', ['chart', 'graph']),
+]
+_KEYWORD_CATEGORY = {w: cat for cat, words in QUESTION_CATEGORIES for w in words}
+_CATEGORY_PRIORITY = {cat: i for i, (cat, _) in enumerate(QUESTION_CATEGORIES)}
+# Zero-width lookahead so overlapping keyword hits are all found in one scan
+_KEYWORD_RE = re.compile('(?=(' + '|'.join(map(re.escape, _KEYWORD_CATEGORY)) + '))')
 
-class QuizSolver:
+# Strategies whose handler actually reads the LLM plan; planning is skipped
+# for everything else (currently no handler uses it)
+NEEDS_PLAN = frozenset()
+
+_HREF_RE = re.compile(r'href=["\']([^"\']+)["\']')
+_URL_RE = re.compile(r'https?://[^\s"<>\']+(?:[/\w\-._~:/?#[\]@!$&\'()*+,;=]*)?')
+_FILE_URL_RE = re.compile(r'https?://[^\s"]+\.(?:pdf|csv|xlsx|json)', re.IGNORECASE)
+_API_URL_RE = re.compile(r'https?://\S+')
+
+# Shared executor for blocking parse work, so it never holds the event loop.
+# Threads rather than processes: spawned workers re-import __main__ (the Quart
+# app, dotenv and a QuizSolver) and each hold their own pandas/pyarrow/MuPDF
+# copy, which costs more than the GIL contention on an I/O-bound server.
+_THREAD_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PARSE_WORKERS', '4')),
+    thread_name_prefix='parse'
+)
+
+
+def shutdown_executors():
+    """Stop the parse executor (called on server shutdown)"""
+    _THREAD_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+def _verified_answer_key(email, quiz_url):
+    # Per email: the same quiz URL may expect a different answer per student
+    return make_key('verified-answer', [email, quiz_url])
+
+
+async def _run_in(pool, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+
+# Shared session so outbound HTTP calls reuse pooled keep-alive connections.
+# Created lazily because aiohttp sessions must be built inside the event loop.
+_http_session = None
+
+
+def _get_http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=50, keepalive_timeout=30)
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """Close the shared HTTP session (called on server shutdown)"""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+class PlaywrightPool:
+    """Process-wide Chromium instance; each render uses its own cheap context"""
+    
     def __init__(self):
-        self.llm = LLMHandler()
+        self._playwright = None
+        self._browser = None
+        self._lock = asyncio.Lock()
     
-    async def render_page(self, url):
-        """Render JavaScript-heavy pages using Playwright"""
-        try:
-            from playwright.async_api import async_playwright
-            
-            async with async_playwright() as p:
+    async def get_browser(self):
+        """Start Playwright and Chromium on first use, relaunching if it died"""
+        async with self._lock:
+            if self._browser is None or not self._browser.is_connected():
+                from playwright.async_api import async_playwright
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
                 # FIX: Add browser arguments for stability
-                browser = await p.chromium.launch(
+                self._browser = await self._playwright.chromium.launch(
                     headless=True,
                     args=[
                         '--no-sandbox',
@@ -34,31 +105,166 @@ class QuizSolver:
                         '--disable-gpu',
                     ]
                 )
-                page = await browser.new_page()
-                
+                logger.info("Chromium launched")
+        return self._browser
+    
+    async def close(self):
+        """Shut down the browser (called on server shutdown)"""
+        async with self._lock:
+            if self._browser is not None:
+                await self._browser.close()
+                self._browser = None
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+
+
+browser_pool = PlaywrightPool()
+
+
+def _pdf_text(content, max_chars=None):
+    """Extract text from PDF bytes with MuPDF, stopping once max_chars are collected"""
+    import pymupdf
+    parts = []
+    total = 0
+    with pymupdf.open(stream=content, filetype='pdf') as doc:
+        for page in doc:
+            text = page.get_text()
+            parts.append(text)
+            total += len(text)
+            if max_chars is not None and total >= max_chars:
+                break
+    return "".join(parts)
+
+
+def _read_csv(content):
+    """Parse CSV bytes with the multithreaded PyArrow engine, falling back to pandas' C parser"""
+    import pandas as pd
+    try:
+        df = pd.read_csv(BytesIO(content), engine='pyarrow', dtype_backend='pyarrow')
+        # PyArrow keeps repeated headers as-is; the C parser renames them a, a.1, ...
+        if not df.columns.has_duplicates:
+            return df
+        logger.info("CSV has duplicate headers, using default engine")
+    except Exception as e:
+        logger.warning(f"PyArrow CSV parse failed, using default engine: {str(e)}")
+    return pd.read_csv(BytesIO(content))
+
+
+def _read_excel(content):
+    """Parse Excel bytes with the Rust calamine engine, falling back to openpyxl"""
+    import pandas as pd
+    try:
+        return pd.read_excel(BytesIO(content), engine='calamine')
+    except Exception as e:
+        logger.warning(f"Calamine Excel parse failed, using default engine: {str(e)}")
+        return pd.read_excel(BytesIO(content))
+
+
+def _dataframe_payload(df, limit=3000):
+    """Compact JSON summary of a DataFrame for prompts: schema, stats, then head rows"""
+    import pandas as pd
+    # Labels become JSON keys, so make them unique strings (a, a.1, ...) the
+    # way pandas' CSV parser does; Excel sheets and str() can both repeat them
+    seen = {}
+    labels = []
+    for label in map(str, df.columns):
+        unique = label
+        n = seen.get(label, 0)
+        while unique in seen:
+            n += 1
+            unique = f"{label}.{n}"
+        seen[label] = n
+        seen[unique] = 0
+        labels.append(unique)
+    df = df.set_axis(labels, axis=1)
+    numeric = df.select_dtypes('number')
+    stats = df.describe(include='all').to_dict() if len(df.columns) else {}
+    summary = {
+        'columns': {c: str(dtype) for c, dtype in df.dtypes.items()},
+        'n_rows': len(df),
+        'sums': numeric.sum().to_dict() if len(numeric.columns) else {},
+        # describe(include='all') pads every column with NaN/NA for inapplicable stats
+        'stats': {c: {k: v for k, v in col.items() if pd.notna(v)} for c, col in stats.items()},
+        'head': df.head(20).to_dict('records'),
+    }
+    # Stats come before rows so truncation drops sample rows, not aggregates
+    return to_prompt_json(summary, limit)
+
+
+def _csv_payload(content):
+    """Parse CSV bytes and summarize them for a prompt; returns (shape, payload)"""
+    df = _read_csv(content)
+    return df.shape, _dataframe_payload(df)
+
+
+def _excel_payload(content):
+    """Parse Excel bytes and summarize them for a prompt; returns (shape, payload)"""
+    df = _read_excel(content)
+    return df.shape, _dataframe_payload(df)
+
+
+class QuizSolver:
+    def __init__(self):
+        self.llm = LLMHandler()
+    
+    async def render_page(self, url):
+        """Render JavaScript-heavy pages using Playwright"""
+        try:
+            browser = await browser_pool.get_browser()
+            context = await browser.new_context()
+            
+            try:
+                from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+                page = await context.new_page()
+                await page.goto(url, wait_until='domcontentloaded', timeout=45000)
+                # Let the quiz scripts fetch and render, but cap the wait so
+                # analytics or long-polling requests can't hold up every quiz
                 try:
-                    await page.goto(url, wait_until='networkidle', timeout=45000)
-                    await page.wait_for_timeout(2000)
-                    
-                    content = await page.content()
-                    text = await page.evaluate('document.body.innerText')
-                    
-                    await browser.close()
-                    return content, text
-                except Exception as e:
-                    await browser.close()
-                    logger.error(f"Error loading page {url}: {str(e)}")
-                    raise
-                    
+                    await page.wait_for_load_state('networkidle', timeout=5000)
+                except PlaywrightTimeoutError:
+                    logger.info(f"Network not idle after 5s, reading page anyway: {url}")
+                await page.wait_for_function(
+                    "document.body && document.body.innerText.trim().length > 0",
+                    timeout=15000
+                )
+                
+                content = await page.content()
+                text = await page.evaluate('document.body.innerText')
+                return content, text
+            except Exception as e:
+                logger.error(f"Error loading page {url}: {str(e)}")
+                raise
+            finally:
+                await context.close()
+            
         except Exception as e:
             logger.error(f"Error rendering page: {str(e)}")
             raise Exception(f"Failed to render page: {str(e)}")
     
-    def solve(self, quiz_url):
+    async def solve(self, quiz_url, email):
         """Main solve method - orchestrates the quiz solving"""
         try:
             logger.info(f"Starting to solve quiz: {quiz_url}")
-            html, text = asyncio.run(self.render_page(quiz_url))
+            
+            # Speculatively look up an answer the server already accepted for this
+            # email and URL while the page renders; a hit skips rendering and the LLM entirely
+            render_task = asyncio.create_task(self.render_page(quiz_url))
+            known_task = asyncio.create_task(llm_cache.get(_verified_answer_key(email, quiz_url)))
+            done, _ = await asyncio.wait(
+                {render_task, known_task}, timeout=3, return_when=asyncio.FIRST_COMPLETED
+            )
+            if known_task in done and known_task.result() is not None:
+                if not render_task.done():
+                    render_task.cancel()
+                elif not render_task.cancelled():
+                    # Retrieve a failed render's exception so asyncio doesn't log it
+                    render_task.exception()
+                logger.info("Reusing previously verified answer")
+                return known_task.result()
+            known_task.cancel()
+            
+            html, text = await render_task
             
             if not html or not text:
                 raise Exception("Failed to render quiz page")
@@ -69,10 +275,13 @@ class QuizSolver:
             logger.info(f"Question: {question}")
             logger.info(f"Submit URL: {submit_url}")
             
-            plan = self.llm.plan_solution(question)
-            logger.info(f"Plan: {plan}")
+            category = self.classify_question(question)
+            plan = None
+            if category in NEEDS_PLAN:
+                plan = await self.llm.aplan_solution(question)
+                logger.info(f"Plan: {plan}")
             
-            answer = self.execute_plan(plan, question, quiz_url, html)
+            answer = await self.execute_plan(plan, category, question, quiz_url, html)
             logger.info(f"Generated answer: {answer}")
             
             return answer
@@ -94,12 +303,10 @@ class QuizSolver:
         """Extract submit URL from HTML - improved regex"""
         try:
             # Look in href attributes first
-            href_pattern = r'href=["\']([^"\']+)["\']'
-            hrefs = re.findall(href_pattern, html)
+            hrefs = _HREF_RE.findall(html)
             
             # Also look for raw URLs
-            url_pattern = r'https?://[^\s"<>\']+(?:[/\w\-._~:/?#[\]@!$&\'()*+,;=]*)?'
-            urls = re.findall(url_pattern, html)
+            urls = _URL_RE.findall(html)
             
             all_urls = hrefs + urls
             submit_urls = [u for u in all_urls if 'submit' in u.lower() or 'answer' in u.lower()]
@@ -117,104 +324,131 @@ class QuizSolver:
             logger.error(f"Error extracting submit URL: {str(e)}")
             return None
     
-    def execute_plan(self, plan, question, quiz_url, html):
+    def classify_question(self, question):
+        """Pick the solving strategy for a question from its keywords"""
+        hits = {_KEYWORD_CATEGORY[m.group(1)] for m in _KEYWORD_RE.finditer(question.lower())}
+        if not hits:
+            return 'generic'
+        return min(hits, key=_CATEGORY_PRIORITY.__getitem__)
+    
+    async def execute_plan(self, plan, category, question, quiz_url, html):
         """Execute the solving strategy based on question type"""
         
-        if 'download' in question.lower() or 'file' in question.lower():
-            answer = self.handle_file_download(question, quiz_url, html)
-        elif 'api' in question.lower() or 'endpoint' in question.lower():
-            answer = self.handle_api_call(question)
-        elif any(x in question.lower() for x in ['sum', 'average', 'count', 'analyze']):
-            answer = self.handle_data_analysis(question, quiz_url, html)
-        elif 'chart' in question.lower() or 'graph' in question.lower():
-            answer = self.handle_visualization(question, quiz_url)
+        if category == 'file':
+            answer = await self.handle_file_download(question, quiz_url, html)
+        elif category == 'api':
+            answer = await self.handle_api_call(question)
+        elif category == 'analysis':
+            answer = await self.handle_data_analysis(question, quiz_url, html)
+        elif category == 'visualization':
+            answer = await self.handle_visualization(question, quiz_url)
         else:
-            answer = self.llm.solve_generic(question)
+            answer = await self.llm.asolve_generic(question)
         
         return answer
     
-    def handle_file_download(self, question, quiz_url, html):
+    async def fetch_bytes(self, url, timeout=30):
+        """Download a URL through the shared HTTP session"""
+        session = _get_http_session()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            return await response.read()
+    
+    async def handle_file_download(self, question, quiz_url, html):
         """Handle questions involving file downloads"""
         try:
-            urls = re.findall(r'https?://[^\s"]+\.(pdf|csv|xlsx|json)', html)
+            urls = _FILE_URL_RE.findall(html)
+            # Prefetch the first few distinct candidates in parallel
+            urls = list(dict.fromkeys(urls))[:3]
             if urls:
-                file_url = urls[0]
-                logger.info(f"Downloading file: {file_url}")
-                response = requests.get(file_url, timeout=30)
+                logger.info(f"Downloading files: {urls}")
+                contents = await asyncio.gather(
+                    *[self.fetch_bytes(u) for u in urls],
+                    return_exceptions=True
+                )
                 
-                if file_url.endswith('.pdf'):
-                    return self.process_pdf(response.content, question)
-                elif file_url.endswith('.csv'):
-                    return self.process_csv(response.content, question)
-                elif file_url.endswith('.xlsx'):
-                    return self.process_excel(response.content, question)
+                for file_url, content in zip(urls, contents):
+                    if isinstance(content, Exception):
+                        logger.warning(f"Download failed for {file_url}: {str(content)}")
+                        continue
+                    extension = file_url.rsplit('.', 1)[-1].lower()
+                    if extension == 'pdf':
+                        return await self.process_pdf(content, question)
+                    elif extension == 'csv':
+                        return await self.process_csv(content, question)
+                    elif extension == 'xlsx':
+                        return await self.process_excel(content, question)
         except Exception as e:
             logger.error(f"Error in file download: {str(e)}")
         
         return "Unable to process file"
     
-    def process_pdf(self, content, question):
+    async def process_pdf(self, content, question):
         """Process PDF files"""
         try:
-            from PyPDF2 import PdfReader
-            reader = PdfReader(BytesIO(content))
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text()
+            text = await _run_in(_THREAD_POOL, _pdf_text, content, 2000)
             logger.info(f"PDF extracted: {len(text)} characters")
-            return self.llm.solve_generic(f"{question}\n\nPDF content: {text[:2000]}")
+            return await self.llm.asolve_generic(
+                f"{question}\n\nPDF content: {text[:2000]}", semantic=False
+            )
         except Exception as e:
             logger.error(f"Error processing PDF: {str(e)}")
             return "PDF processing failed"
     
-    def process_csv(self, content, question):
+    async def process_csv(self, content, question):
         """Process CSV files"""
         try:
-            import pandas as pd
-            df = pd.read_csv(BytesIO(content))
-            logger.info(f"CSV loaded: {df.shape[0]} rows, {df.shape[1]} columns")
-            return self.llm.solve_generic(f"{question}\n\nData: {df.to_string()[:2000]}")
+            shape, payload = await _run_in(_THREAD_POOL, _csv_payload, content)
+            logger.info(f"CSV loaded: {shape[0]} rows, {shape[1]} columns")
+            return await self.llm.asolve_generic(
+                f"{question}\n\nData: {payload}", semantic=False
+            )
         except Exception as e:
             logger.error(f"Error processing CSV: {str(e)}")
             return "CSV processing failed"
     
-    def process_excel(self, content, question):
+    async def process_excel(self, content, question):
         """Process Excel files"""
         try:
-            import pandas as pd
-            df = pd.read_excel(BytesIO(content))
-            logger.info(f"Excel loaded: {df.shape[0]} rows, {df.shape[1]} columns")
-            return self.llm.solve_generic(f"{question}\n\nData: {df.to_string()[:2000]}")
+            shape, payload = await _run_in(_THREAD_POOL, _excel_payload, content)
+            logger.info(f"Excel loaded: {shape[0]} rows, {shape[1]} columns")
+            return await self.llm.asolve_generic(
+                f"{question}\n\nData: {payload}", semantic=False
+            )
         except Exception as e:
             logger.error(f"Error processing Excel: {str(e)}")
             return "Excel processing failed"
     
-    def handle_api_call(self, question):
+    async def handle_api_call(self, question):
         """Handle API-based questions"""
         try:
-            api_match = re.search(r'https://[^\s]+', question)
+            api_match = _API_URL_RE.search(question)
             if api_match:
                 api_url = api_match.group(0)
                 logger.info(f"Calling API: {api_url}")
-                response = requests.get(api_url, timeout=10)
-                data = response.json()
-                return self.llm.solve_generic(f"{question}\n\nAPI Response: {json.dumps(data)[:2000]}")
+                session = _get_http_session()
+                async with session.get(api_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    data = await response.json(content_type=None)
+                return await self.llm.asolve_generic(
+                    f"{question}\n\nAPI Response: {to_prompt_json(data, 2000)}", semantic=False
+                )
         except Exception as e:
             logger.error(f"Error in API call: {str(e)}")
         
         return "API call failed"
     
-    def handle_data_analysis(self, question, quiz_url, html):
+    async def handle_data_analysis(self, question, quiz_url, html):
         """Handle data analysis questions"""
         logger.info("Handling data analysis question")
-        return self.llm.solve_generic(question)
+        # Analysis answers hinge on exact figures; never reuse a neighbour's
+        return await self.llm.asolve_generic(question, semantic=False)
     
-    def handle_visualization(self, question, quiz_url):
+    async def handle_visualization(self, question, quiz_url):
         """Handle visualization questions"""
         logger.info("Handling visualization question")
-        return self.llm.solve_generic(question)
+        return await self.llm.asolve_generic(question)
     
-    def submit_answer(self, email, secret, url, answer):
+    async def submit_answer(self, email, secret, url, answer):
         """Submit the answer back to the server"""
         payload = {
             'email': email,
@@ -227,8 +461,15 @@ class QuizSolver:
         
         try:
             logger.info(f"Submitting answer to {submit_endpoint}")
-            response = requests.post(submit_endpoint, json=payload, timeout=30)
-            return response.json()
+            session = _get_http_session()
+            async with session.post(
+                submit_endpoint, json=payload, timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                result = await response.json(content_type=None)
+            
+            if isinstance(result, dict) and result.get('correct') is True:
+                await llm_cache.set(_verified_answer_key(email, url), answer, ttl=3600)
+            return result
         except Exception as e:
             logger.error(f"Error submitting answer: {str(e)}")
             return {'error': str(e)}